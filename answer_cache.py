@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class AnswerCache:
+    """Exact-match cache of model answers, persisted to a JSON file"""
+
+    def __init__(
+        self,
+        path: str = "answer_cache.json",
+        max_answers: int = 10000,
+        max_contexts: int = 16,
+    ):
+        self.path = path
+        self.max_answers = max_answers
+        # Labels and histories are kept for the max_contexts most recently
+        # used contexts. Within a context they only grow with the form fields
+        # answered, and the app caps the answers kept per label.
+        self.max_contexts = max_contexts
+        # labels: context hash -> {"type|normalized label": [label, answer]}
+        # histories: context hash -> {label: every answer given to it}
+        # Each is ordered from least to most recently used, so the oldest
+        # entries are the ones evicted once it is full
+        answers, labels, histories = self._load()
+        self.answers = OrderedDict(answers)
+        self.labels = OrderedDict(labels)
+        self.histories = OrderedDict(histories)
+        self.dirty = False
+
+    def _load(self) -> tuple:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}, {}, {}
+        if "answers" in data and "labels" in data:
+            return data["answers"], data["labels"], data.get("histories", {})
+        # Caches written before answers were also stored per label
+        return data, {}, {}
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Hash the given parts into a fixed-size cache key"""
+        return hashlib.sha256("||".join(parts).encode()).hexdigest()
+
+    def _use(self, entries: OrderedDict, key: str, limit: int):
+        """Mark an entry as most recently used and evict the oldest past limit"""
+        if key not in entries:
+            return
+        if next(reversed(entries)) != key:
+            entries.move_to_end(key)
+            # Save the new order too, so eviction follows use across sessions
+            self.dirty = True
+        while len(entries) > limit:
+            entries.popitem(last=False)
+            self.dirty = True
+
+    def get(self, key: str) -> Optional[str]:
+        self._use(self.answers, key, self.max_answers)
+        return self.answers.get(key)
+
+    def put(self, key: str, answer: str):
+        if self.answers.get(key) != answer:
+            self.answers[key] = answer
+            self.dirty = True
+        self._use(self.answers, key, self.max_answers)
+
+    @staticmethod
+    def label_key(label: str, field_type: str) -> str:
+        """Key a field by its type and case- and whitespace-insensitive label"""
+        return f"{field_type}|{' '.join(label.lower().split())}"
+
+    def get_label(
+        self, context_hash: str, label: str, field_type: str
+    ) -> Optional[str]:
+        """Return the answer last given to this field label for this context"""
+        self._use(self.labels, context_hash, self.max_contexts)
+        entry = self.labels.get(context_hash, {}).get(self.label_key(label, field_type))
+        return entry[1] if entry else None
+
+    def put_label(self, context_hash: str, label: str, field_type: str, answer: str):
+        entries = self.labels.setdefault(context_hash, {})
+        key = self.label_key(label, field_type)
+        if entries.get(key) != [label, answer]:
+            entries[key] = [label, answer]
+            self.dirty = True
+        self._use(self.labels, context_hash, self.max_contexts)
+
+    def label_answers(self, context_hash: str) -> Dict[str, str]:
+        """Map each label answered for this context to its answer"""
+        self._use(self.labels, context_hash, self.max_contexts)
+        return dict(self.labels.get(context_hash, {}).values())
+
+    def get_history(self, context_hash: str) -> Dict[str, List[str]]:
+        self._use(self.histories, context_hash, self.max_contexts)
+        return self.histories.get(context_hash, {})
+
+    def put_history(self, context_hash: str, history: Dict[str, List[str]]):
+        if self.histories.get(context_hash) != history:
+            self.histories[context_hash] = {
+                label: list(answers) for label, answers in history.items()
+            }
+            self.dirty = True
+        self._use(self.histories, context_hash, self.max_contexts)
+
+    def clear(self):
+        self.answers = OrderedDict()
+        self.labels = OrderedDict()
+        self.histories = OrderedDict()
+        self.dirty = True
+
+    def save(self):
+        """Write the cache to disk if it changed since the last save"""
+        if not self.dirty:
+            return
+        # Write to a temporary file first so an interrupted save can't leave
+        # a truncated cache behind, which would be dropped on the next load
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "answers": self.answers,
+                    "labels": self.labels,
+                    "histories": self.histories,
+                },
+                f,
+            )
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+
+class SemanticCache:
+    """In-memory cache that reuses answers for semantically similar fields"""
+
+    def __init__(
+        self, threshold: float = 0.92, max_entries: int = 4096, grow_by: int = 256
+    ):
+        self.threshold = threshold
+        # Once max_entries answers are cached, each new one replaces the oldest
+        self.max_entries = max_entries
+        # The matrix grows this many rows at a time rather than being copied
+        # on every add
+        self.grow_by = grow_by
+        self.embeddings = None
+        # (answer, context chain hash, field type) for each filled row of
+        # self.embeddings
+        self.entries = []
+        # Row the next answer is written to
+        self.next_row = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding: List[float], chain_hash: str, field_type: Optional[str]
+    ) -> Optional[str]:
+        """Return the closest cached answer above the similarity threshold"""
+        if self.embeddings is None:
+            return None
+        query = self._normalize(embedding)
+        if query.shape[0] != self.embeddings.shape[1]:
+            return None
+
+        # Only reuse answers given for the same applicant context and type of
+        # field, so other rows are ruled out before picking the closest
+        candidates = np.fromiter(
+            (
+                entry_chain_hash == chain_hash and entry_field_type == field_type
+                for _, entry_chain_hash, entry_field_type in self.entries
+            ),
+            dtype=bool,
+            count=len(self.entries),
+        )
+        if not candidates.any():
+            return None
+        scores = np.where(
+            candidates, self.embeddings[: len(self.entries)] @ query, -np.inf
+        )
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return self.entries[best][0]
+        return None
+
+    def add(
+        self,
+        embedding: List[float],
+        answer: str,
+        chain_hash: str,
+        field_type: Optional[str],
+    ):
+        vector = self._normalize(embedding)
+        if self.embeddings is None or vector.shape[0] != self.embeddings.shape[1]:
+            # Start over if the embedding model (and its dimension) changed
+            self.embeddings = np.empty(
+                (min(self.grow_by, self.max_entries), vector.shape[0]),
+                dtype=np.float32,
+            )
+            self.entries = []
+            self.next_row = 0
+
+        row = self.next_row
+        if row == self.max_entries:
+            # Full, so overwrite the oldest row
+            row = 0
+        elif row == len(self.embeddings):
+            grown = np.empty(
+                (min(row + self.grow_by, self.max_entries), vector.shape[0]),
+                dtype=np.float32,
+            )
+            grown[:row] = self.embeddings
+            self.embeddings = grown
+        self.embeddings[row] = vector
+        if row < len(self.entries):
+            self.entries[row] = (answer, chain_hash, field_type)
+        else:
+            self.entries.append((answer, chain_hash, field_type))
+        self.next_row = row + 1
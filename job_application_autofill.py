@@ -1,15 +1,306 @@
+import hashlib
 import json
-import requests
+import mmap
+import os
 import subprocess
+import threading
 import re
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.webdriver.chrome.options import Options as ChromeOptions
+import signal
+import socket
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from model_interface import get_model_interface
+from selenium.webdriver.support.ui import Select
+from answer_cache import AnswerCache, SemanticCache
+
+try:
+    # C HTML parser, faster and more forgiving than the regex fallback
+    from lxml.html import fromstring as parse_html
+except ImportError:
+    parse_html = None
+
+try:
+    # C++ edit distance, much faster than levenshtein_distance's Python loops
+    from rapidfuzz.distance import Levenshtein
+    from rapidfuzz.process import extractOne
+except ImportError:
+    extractOne = None
+from model_interface import (
+    OLLAMA_EMBEDDING_MODEL,
+    OLLAMA_NUM_PARALLEL,
+    OLLAMA_ERROR_RESPONSE,
+    MODEL_CONTEXT_TOKENS,
+    MAX_ANSWER_TOKENS,
+    GENERATION_METHODS,
+    DEFAULT_GENERATION_METHOD,
+    GenerationCancelled,
+    get_model_interface,
+)
+
+# Locators shared by every form and field lookup
+FORM_LOCATOR = (By.XPATH, "ancestor::form")
+MODAL_IFRAME_LOCATOR = (By.CSS_SELECTOR, "#modal > iframe")
+BODY_LOCATOR = (By.TAG_NAME, "body")
+FORM_FIELDS_LOCATOR = (By.CSS_SELECTOR, "input,textarea,select")
+
+# Chrome is started with remote debugging on this address and its own profile,
+# so later runs can attach to the same, already logged in, browser
+CHROME_DEBUGGER_ADDRESS = "127.0.0.1:9222"
+CHROME_PROFILE_DIR = os.path.expanduser("~/.job_application_autofill/chrome")
+
+# Opening tag of every field in a form's HTML, and each attribute in it, for
+# when lxml isn't installed
+INPUT_TAG_RE = re.compile(r"<(?P<tag>input|textarea|select)[^>]*>", re.IGNORECASE)
+ATTRIBUTE_RE = re.compile(
+    r"""\s(?P<name>[\w:-]+)\s*=\s*(?:"(?P<double>[^"]*)"|'(?P<single>[^']*)'|(?P<bare>[^\s"'>]+))"""
+)
+
+# Rough number of characters per token, to size text without a tokenizer
+CHARS_PER_TOKEN = 4
+
+# Contact details that are read straight from the context file, and the field
+# labels (or ids/names) that ask for each of them. A phone number only spans
+# spaces, never a line break into the next line of the resume.
+PROFILE_PATTERNS = {
+    "linkedin": re.compile(
+        r"(?:https?://)?(?:www\.)?linkedin\.com/in/[\w-]+/?", re.IGNORECASE
+    ),
+    "github": re.compile(
+        r"(?:https?://)?(?:www\.)?github\.com/[\w-]+/?", re.IGNORECASE
+    ),
+    "email": re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"),
+    "phone": re.compile(r"\+\d[\d ().-]{8,18}\d|\(?\b\d{3}\)?[ .-]?\d{3}[ .-]?\d{4}\b"),
+}
+# The field patterns must match a label's (or id's or name's) whole list of
+# words, as given by field_words, so a question that merely mentions LinkedIn
+# or a phone doesn't get the profile detail typed into it
+PROFILE_FIELD_PATTERNS = {
+    "linkedin": re.compile(r"(?:your )?linked ?in(?: (?:profile|url|link|page))*"),
+    "github": re.compile(r"(?:your )?git ?hub(?: (?:profile|url|link|page))*"),
+    "email": re.compile(r"(?:your )?(?:contact )?e ?mail(?: address)?"),
+    "phone": re.compile(
+        r"(?:your )?(?:contact )?(?:(?:mobile|cell|home|work|primary) )?"
+        r"(?:phone|telephone|mobile|cell|tel)(?: (?:number|no))?"
+    ),
+}
+# Splits camelCase ids and names into words, and finds the words of a label
+CAMEL_CASE_RE = re.compile(r"([a-z])([A-Z])")
+WORD_RE = re.compile(r"[a-z]+")
+# Words that mark whether a field must be filled rather than what it asks for
+FIELD_MARKER_WORDS = {"optional", "required"}
+# The profile detail each input type holds, which settles a label that could
+# ask for more than one
+PROFILE_INPUT_TYPES = {"email": "email", "tel": "phone"}
+# Input types a profile detail can be typed into
+TEXT_INPUT_TYPES = {"", "text", "email", "tel", "url"}
+
+# Number of alternative answers remembered for each field label
+MAX_ANSWERS_PER_LABEL = 16
+
+# Longest answer reused word for word for a field with the same label. Longer
+# free-text answers, like why the applicant wants this job, are written anew
+# for each application.
+MAX_LABEL_ANSWER_LENGTH = 100
+
+# Number of the application's latest answers embedded along with a field's
+# type and label for the semantic cache, so the same label asked in another
+# context isn't served the same answer
+SEMANTIC_CONTEXT_ANSWERS = 2
+
+# Answer length limits, in tokens, for fields that only take a short answer;
+# other fields use the model interface's default limit
+FIELD_ANSWER_TOKENS = {"checkbox": 4, "radio": 16, "select": 16, "textarea": 512}
+
+# Generation method used when the user asks for a new answer. The default
+# greedy decoding would just repeat the answer being replaced.
+REGENERATION_METHOD = "sampling"
+
+# Tokens of JSON syntax (key, quotes, separators) around each answer in a
+# whole-form JSON answer
+JSON_TOKENS_PER_FIELD = 8
+
+# Input types that are never answered by the model
+SKIPPED_INPUT_TYPES = {"file", "hidden", "submit", "button", "reset", "image"}
+
+# Defines fieldLabel(e), which resolves the text describing a form field by
+# trying, in order: <label for=id>, an ancestor <label>, aria-label,
+# placeholder, the closest preceding <label>, a preceding sibling label, and
+# finally the field's name. The XPath expressions are compiled once per script
+# execution rather than once per field.
+FIELD_LABEL_JS = """
+const precedingLabel = document.createExpression("preceding::label[1]");
+const precedingSiblingLabel = document.createExpression(
+    "./preceding-sibling::*[self::label or contains(@class, 'label')][1]"
+);
+
+function fieldLabel(e) {
+    const text = (node) => (node && node.innerText ? node.innerText.trim() : "");
+    const first = (expression) =>
+        expression.evaluate(e, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    return (
+        (e.id && text(document.querySelector(`label[for="${CSS.escape(e.id)}"]`))) ||
+        text(e.closest("label")) ||
+        e.getAttribute("aria-label") ||
+        e.getAttribute("placeholder") ||
+        text(first(precedingLabel)) ||
+        text(first(precedingSiblingLabel)) ||
+        e.getAttribute("name") ||
+        "Unknown field"
+    );
+}
+"""
+
+# Defines fieldHtml(e), which returns the HTML of the nearest block around a
+# form field (its whole fieldset for radio buttons), cut to FIELD_HTML_LENGTH.
+# Styling, scripts, images and every attribute not in FIELD_HTML_ATTRIBUTES
+# are stripped first, since they only add tokens to the prompt.
+FIELD_HTML_LENGTH = 2000
+FIELD_HTML_ATTRIBUTES = [
+    "id",
+    "name",
+    "type",
+    "for",
+    "value",
+    "placeholder",
+    "aria-label",
+    "required",
+    "multiple",
+    "maxlength",
+    "checked",
+    "selected",
+]
+FIELD_HTML_JS = f"""
+const KEPT_ATTRIBUTES = new Set({json.dumps(FIELD_HTML_ATTRIBUTES)});
+
+function fieldHtml(e) {{
+    const container =
+        (e.type === "radio" && e.closest("fieldset, [role=radiogroup]")) ||
+        e.closest("fieldset, div, section") ||
+        e.parentElement ||
+        e;
+    const copy = container.cloneNode(true);
+    copy.querySelectorAll("script, style, svg, img, noscript").forEach((n) => n.remove());
+    for (const node of [copy, ...copy.querySelectorAll("*")]) {{
+        for (const name of node.getAttributeNames()) {{
+            if (!KEPT_ATTRIBUTES.has(name)) node.removeAttribute(name);
+        }}
+    }}
+    return copy.outerHTML.slice(0, {FIELD_HTML_LENGTH});
+}}
+"""
+
+# Defines fieldInfo(e), which returns the metadata the autofill needs about a
+# form field, including a select's option texts and the question (legend) of
+# a radio button's group
+FIELD_INFO_JS = (
+    FIELD_LABEL_JS
+    + FIELD_HTML_JS
+    + """
+function groupLabel(e) {
+    const group = e.closest("fieldset, [role=radiogroup]");
+    if (!group) return "";
+    const legend = group.querySelector("legend");
+    return (legend && legend.innerText.trim()) || group.getAttribute("aria-label") || "";
+}
+
+function fieldInfo(e) {
+    const style = window.getComputedStyle(e);
+    return {
+        tag: e.tagName.toLowerCase(),
+        type: (e.getAttribute("type") || "").toLowerCase(),
+        id: e.id || "",
+        name: e.getAttribute("name") || "",
+        placeholder: e.getAttribute("placeholder") || "",
+        label: fieldLabel(e),
+        html: fieldHtml(e),
+        group: e.type === "radio" ? groupLabel(e) : "",
+        options: e.tagName === "SELECT" ? Array.from(e.options, (o) => o.text.trim()) : [],
+        value: e.value ?? "",
+        visible: e.offsetParent !== null && style.visibility !== "hidden",
+        enabled: !e.disabled,
+    };
+}
+"""
+)
+
+# Collects the metadata of a list of form fields in a single script execution
+COLLECT_FIELDS_JS = FIELD_INFO_JS + "return arguments[0].map(fieldInfo);"
+
+# Returns the focused element together with its metadata
+ACTIVE_FIELD_JS = (
+    FIELD_INFO_JS
+    + """
+const e = document.activeElement;
+return [e, fieldInfo(e)];
+"""
+)
+
+# Instructions that start every single-field prompt
+FIELD_PROMPT_INSTRUCTIONS = (
+    "Fill in the form field described below, whose surrounding HTML is given. Respond with exactly what the job applicant would say in response for the field. "
+    "Consider the field's type and label, and the answers already given in this application. Note that your whole and complete response will be filled in as the input field's value, meaning only respond with exactly what the job applicant would say. Keep the answer concise and relevant to the field type and context.\n\n"
+)
+
+# Tokens of the model's context kept free for everything sent after the
+# applicant context: the instructions, the field's HTML, the answers already
+# given in the application (up to HISTORY_TOKEN_BUDGET), and the answer itself
+HISTORY_TOKEN_BUDGET = 1024
+RESERVED_PROMPT_TOKENS = (
+    (len(FIELD_PROMPT_INSTRUCTIONS) + FIELD_HTML_LENGTH) // CHARS_PER_TOKEN
+    + HISTORY_TOKEN_BUDGET
+    + MAX_ANSWER_TOKENS
+)
+
+# Defines setValue(e, value), which sets a field's value through the native
+# setter, so frameworks like React that track the value property notice the
+# change, and notifies the page's input listeners
+SET_VALUE_FUNCTION_JS = """
+function setValue(e, value) {
+    const setter = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(e), "value")?.set;
+    if (setter) setter.call(e, value);
+    else e.value = value;
+    e.dispatchEvent(new Event("input", { bubbles: true }));
+}
+"""
+
+# Replaces a field's value in one command instead of typing it key by key
+SET_VALUE_JS = (
+    SET_VALUE_FUNCTION_JS
+    + """
+setValue(arguments[0], arguments[1]);
+arguments[0].dispatchEvent(new Event("change", { bubbles: true }));
+"""
+)
+
+# Appends text to a field's value
+APPEND_VALUE_JS = (
+    SET_VALUE_FUNCTION_JS + "setValue(arguments[0], arguments[0].value + arguments[1]);"
+)
+
+
+class ElementStreamWriter:
+    """Buffers streamed text and appends it to an element at most every interval"""
+
+    def __init__(self, driver, element, interval=0.05):
+        self.driver = driver
+        self.element = element
+        self.interval = interval
+        self.parts = []
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.parts.append(text)
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.driver.execute_script(
+                APPEND_VALUE_JS, self.element, "".join(self.parts)
+            )
+            self.parts = []
+        self.last_flush = time.monotonic()
 
 
 class JobApplicationAutofill:
@@ -17,10 +308,26 @@ class JobApplicationAutofill:
         self.driver = None
         self.context_file = ""
         self.context = ""
+        self.context_hash = ""
+        # Contact details found in the context, keyed like PROFILE_PATTERNS
+        self.profile = {}
+        self.system_prompt = ""
         self.current_application_context = []
+        # current_application_context as chat messages, kept in step with it
+        self.application_messages = []
+        # Estimated tokens of application_messages, kept to HISTORY_TOKEN_BUDGET
+        self.history_tokens = 0
         self.answer_history = {}
+        # Index of each answer within its label's answer_history list
+        self.answer_positions = {}
+        # (field HTML, prompt) last built for each (type, id, label) field
+        self.last_prompts = {}
         self.model_interface = None
+        self.answer_cache = AnswerCache()
+        self.semantic_cache = SemanticCache()
         self.config = self.load_config()
+        # Config changes are written once on exit instead of on every change
+        self.config_dirty = False
 
     def load_config(self):
         try:
@@ -30,47 +337,104 @@ class JobApplicationAutofill:
             return {
                 "context_file": "",
                 "model_type": "ollama",
-                "ollama_model_name": "llama3.2",
+                "ollama_model_name": "llama3.2:3b-instruct-q4_K_M",
                 "hf_model_name": "meta-llama/Llama-3.2-3B-Instruct",
+                "generation_method": DEFAULT_GENERATION_METHOD,
                 "browser": "",
             }
 
     def save_config(self):
-        with open("config.json", "w") as f:
+        self.config_dirty = False
+        # Write to a temporary file first so an interrupted save can't leave
+        # a truncated config.json behind
+        with open("config.json.tmp", "w") as f:
             json.dump(
                 {
                     "context_file": self.context_file,
                     "model_type": self.config["model_type"],
                     "ollama_model_name": self.config["ollama_model_name"],
                     "hf_model_name": self.config["hf_model_name"],
+                    "generation_method": self.generation_method(),
                     "browser": self.config.get("browser", ""),
                 },
                 f,
             )
+        os.replace("config.json.tmp", "config.json")
 
     def setup_browser(self):
         if not self.config.get("browser"):
             self.choose_browser()
 
+        # Import the browser drivers here since only one of them is ever used
         if self.config["browser"].lower() == "firefox":
+            from selenium.webdriver import Firefox
+            from selenium.webdriver.firefox.options import Options as FirefoxOptions
+
             options = FirefoxOptions()
             options.add_argument("--start-maximized")
-            self.driver = webdriver.Firefox(options=options)
+            self.driver = Firefox(options=options)
         else:  # Default to Chrome
+            from selenium.webdriver import Chrome
+            from selenium.webdriver.chrome.options import Options as ChromeOptions
+
             options = ChromeOptions()
+            if self._chrome_debugger_running():
+                print("Attaching to the Chrome window left open by the last run.")
+                options.debugger_address = CHROME_DEBUGGER_ADDRESS
+                self.driver = Chrome(options=options)
+                self._configure_driver_connection()
+                return
+
+            port = CHROME_DEBUGGER_ADDRESS.rsplit(":", 1)[1]
             options.add_argument("--start-maximized")
-            self.driver = webdriver.Chrome(options=options)
+            options.add_argument(f"--remote-debugging-port={port}")
+            options.add_argument(f"--user-data-dir={CHROME_PROFILE_DIR}")
+            # Keep the browser open after exiting so the next run can attach
+            options.add_experimental_option("detach", True)
+            self.driver = Chrome(options=options)
+        self._configure_driver_connection()
 
         # Navigate to LinkedIn.com
         self.driver.get("https://www.linkedin.com")
         print("Navigated to LinkedIn.com")
 
+    def _chrome_debugger_running(self):
+        host, port = CHROME_DEBUGGER_ADDRESS.rsplit(":", 1)
+        try:
+            with socket.create_connection((host, int(port)), timeout=0.2):
+                return True
+        except OSError:
+            return False
+
+    def release_browser(self):
+        if self.config["browser"].lower() == "firefox":
+            self.driver.quit()
+        else:
+            # Only stop chromedriver, leaving Chrome running for the next run
+            self.driver.service.stop()
+
+    def _configure_driver_connection(self):
+        # Missing elements are looked up with find_elements, so never wait
+        self.driver.implicitly_wait(0)
+
+        # Selenium's keep-alive PoolManager holds a single connection to the
+        # driver; give it room for several so commands never reconnect
+        executor = self.driver.command_executor
+        if getattr(executor, "_proxy_url", None):
+            return
+        if hasattr(executor, "_conn"):
+            executor._conn.clear()
+        executor.keep_alive = True
+        executor._conn = urllib3.PoolManager(
+            maxsize=16, block=False, timeout=executor.get_timeout()
+        )
+
     def choose_browser(self):
         while True:
             choice = input("Choose your browser (firefox/chrome): ").lower()
             if choice in ["firefox", "chrome"]:
                 self.config["browser"] = choice
-                self.save_config()
+                self.config_dirty = True
                 break
             else:
                 print("Invalid choice. Please enter 'firefox' or 'chrome'.")
@@ -81,124 +445,698 @@ class JobApplicationAutofill:
         else:
             file_path = input("Enter the path to your context file: ")
         try:
-            with open(file_path, "r") as file:
-                self.context = file.read()
-            self.context_file = file_path
-            print("Context file loaded successfully.")
-            self.save_config()
+            with open(file_path, "rb") as file:
+                # Map the file instead of copying it so the hash is computed
+                # straight from the raw bytes; mmap can't map empty files
+                if os.fstat(file.fileno()).st_size:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        context_hash = hashlib.blake2b(data, digest_size=16)
+                        context = data[:].decode("utf-8")
+                else:
+                    context_hash = hashlib.blake2b(b"", digest_size=16)
+                    context = ""
         except FileNotFoundError:
             print("File not found. Please check the path and try again.")
+            return
+
+        # Refuse a context that leaves no room in the model for the prompt and
+        # answer, rather than letting Ollama silently cut off its start
+        context_tokens = len(context) // CHARS_PER_TOKEN
+        max_context_tokens = MODEL_CONTEXT_TOKENS - RESERVED_PROMPT_TOKENS
+        if context_tokens > max_context_tokens:
+            print(
+                f"Context file is too large (about {context_tokens} tokens, the "
+                f"limit is {max_context_tokens}). Please shorten it and try again."
+            )
+            return
+
+        self.context = context
+        self.context_hash = context_hash.hexdigest()
+        self.profile = {}
+        for key, pattern in PROFILE_PATTERNS.items():
+            match = pattern.search(context)
+            if match:
+                self.profile[key] = match.group(0).strip()
+        self.system_prompt = self.create_system_prompt()
+        self.prime_answer_history()
+        print("Context file loaded successfully.")
+        if file_path != self.context_file:
+            self.context_file = file_path
+            self.config_dirty = True
+
+    def prime_answer_history(self):
+        """Start from the answers given to each label in earlier sessions"""
+        for label, answers in self.answer_cache.get_history(self.context_hash).items():
+            self.answer_history.setdefault(label, list(answers))
+        for label, answer in self.answer_cache.label_answers(self.context_hash).items():
+            self.answer_history.setdefault(label, [answer])
+
+        for label, answers in self.answer_history.items():
+            if label not in self.answer_positions:
+                self.answer_positions[label] = self.index_answers(answers)
+
+    @staticmethod
+    def index_answers(answers):
+        """Map each answer to the index of its first occurrence"""
+        positions = {}
+        for index, answer in enumerate(answers):
+            positions.setdefault(answer, index)
+        return positions
+
+    def add_alternative_answer(self, label, answer):
+        """Add an answer to the label's history as its newest answer"""
+        answers = self.answer_history.setdefault(label, [])
+        positions = self.answer_positions.setdefault(label, {})
+        if answer in positions:
+            # A repeated answer moves to the end, shifting the ones after it
+            answers.remove(answer)
+            answers.append(answer)
+            self.answer_positions[label] = self.index_answers(answers)
+            return
+        answers.append(answer)
+        if len(answers) > MAX_ANSWERS_PER_LABEL:
+            # Drop the oldest answer, which shifts every other one's index
+            del answers[0]
+            self.answer_positions[label] = self.index_answers(answers)
+        else:
+            positions[answer] = len(answers) - 1
+
+    def save_answers(self):
+        self.answer_cache.put_history(self.context_hash, self.answer_history)
+        self.answer_cache.save()
+
+    def clear_cache(self):
+        self.answer_cache.clear()
+        self.answer_cache.save()
+        self.semantic_cache = SemanticCache()
+        self.answer_history = {}
+        self.answer_positions = {}
+        print("Cached answers cleared.")
 
     def new_application(self):
         self.current_application_context = []
+        self.application_messages = []
+        self.history_tokens = 0
+        self.last_prompts = {}
+        self.save_answers()
         print("Starting a new application. Previous context cleared.")
 
     def switch_to_latest_tab(self):
         if self.driver.window_handles:
             self.driver.switch_to.window(self.driver.window_handles[-1])
 
-    def get_form_html(self):
+    def get_form_element(self):
+        # find_elements returns an empty list straight away when nothing
+        # matches, rather than raising after the implicit wait
         try:
             self.switch_to_latest_tab()
             current_element = self.driver.switch_to.active_element
-            form = current_element.find_element(By.XPATH, "ancestor::form")
-            return form.get_attribute("outerHTML")
-        except NoSuchElementException:
-            try:
-                # Try checking if there's an iframe with a form instead
-                iframe = self.driver.find_element(By.CSS_SELECTOR, "#modal > iframe")
-                # Switch to iframe
-                self.driver.switch_to.frame(iframe)
-
-                current_element = self.driver.switch_to.active_element
-                form = current_element.find_element(By.XPATH, "ancestor::form")
-                return form.get_attribute("outerHTML")
-            except NoSuchElementException:
-                pass
-            except Exception as e:
-                print(f"Error getting form HTML in iframe: {e}")
-                return None
+            forms = current_element.find_elements(*FORM_LOCATOR)
+            if forms:
+                return forms[0]
+
+            # Try checking if there's an iframe with a form instead
+            iframes = self.driver.find_elements(*MODAL_IFRAME_LOCATOR)
+            if iframes:
+                try:
+                    self.driver.switch_to.frame(iframes[0])
+                    current_element = self.driver.switch_to.active_element
+                    forms = current_element.find_elements(*FORM_LOCATOR)
+                    if forms:
+                        return forms[0]
+                except Exception as e:
+                    print(f"Error getting form HTML in iframe: {e}")
+                    return None
 
             print("No form found containing the current element. Using body instead.")
-            return self.driver.find_element(By.TAG_NAME, "body").get_attribute(
-                "outerHTML"
-            )
+            return self.driver.find_element(*BODY_LOCATOR)
         except Exception as e:
             print(f"Error getting form HTML: {e}")
             return None
 
+    def collect_form_fields(self, form):
+        elements = form.find_elements(*FORM_FIELDS_LOCATOR)
+        if not elements:
+            return []
+
+        # Read every field's metadata in one WebDriver round-trip
+        metadata = self.driver.execute_script(COLLECT_FIELDS_JS, elements)
+
+        fields = []
+        for element, info in zip(elements, metadata):
+            if not info["visible"] or not info["enabled"]:
+                continue
+            if info["type"] in SKIPPED_INPUT_TYPES:
+                continue
+            info["element"] = element
+            fields.append(info)
+        return fields
+
     def extract_input_elements(self, html):
-        pattern = r"<(?:input|textarea|select)[^>]*>"
-        return re.findall(pattern, html, re.IGNORECASE)
+        """Lazily yield (tag name, attributes) for each form field"""
+        if parse_html is not None:
+            for element in parse_html(html).iter("input", "textarea", "select"):
+                yield element.tag, dict(element.attrib)
+            return
+
+        for match in INPUT_TAG_RE.finditer(html):
+            attributes = {}
+            for attribute in ATTRIBUTE_RE.finditer(match.group(0)):
+                value = [v for v in attribute.group("double", "single", "bare") if v]
+                attributes[attribute.group("name").lower()] = value[0] if value else ""
+            yield match.group("tag").lower(), attributes
+
+    def current_model_name(self):
+        if self.config["model_type"] == "huggingface":
+            return self.config["hf_model_name"]
+        return self.config["ollama_model_name"]
+
+    def generation_method(self):
+        return self.config.get("generation_method", DEFAULT_GENERATION_METHOD)
+
+    def cache_key(self, prompt):
+        return AnswerCache.make_key(
+            self.context_hash,
+            prompt,
+            self.current_model_name(),
+            self.generation_method(),
+        )
+
+    def cache_answer(self, key, response, embedding=None, field_type=None):
+        if not response or response == OLLAMA_ERROR_RESPONSE:
+            return
+        self.answer_cache.put(key, response)
+        if embedding is not None:
+            self.semantic_cache.add(embedding, response, self.context_hash, field_type)
+
+    def semantic_text(self, label, field_type):
+        """Text embedded for a field: its type, label and the latest answers"""
+        lines = [
+            f"{question}: {answer}"
+            for question, answer in self.current_application_context[
+                -SEMANTIC_CONTEXT_ANSWERS:
+            ]
+        ]
+        lines.append(f"{field_type} field: {label}")
+        return "\n".join(lines)
+
+    def find_similar_answer(self, label, field_type):
+        """Return (answer, embedding) for the closest previously answered field"""
+        embedding = self.model_interface.embed(self.semantic_text(label, field_type))
+        if embedding is None:
+            return None, None
+        return (
+            self.semantic_cache.lookup(embedding, self.context_hash, field_type),
+            embedding,
+        )
+
+    def find_similar_answers(self, fields):
+        """Return (answer, embedding) pairs for several fields, embedded at once"""
+        field_types = [self.field_type(field) for field in fields]
+        embeddings = self.model_interface.embed_many(
+            [
+                self.semantic_text(field["label"], field_type)
+                for field, field_type in zip(fields, field_types)
+            ]
+        )
+        return [
+            (
+                (None, None)
+                if embedding is None
+                else (
+                    self.semantic_cache.lookup(
+                        embedding, self.context_hash, field_type
+                    ),
+                    embedding,
+                )
+            )
+            for embedding, field_type in zip(embeddings, field_types)
+        ]
+
+    def lookup_answer(self, prompt, label=None, field_type=None):
+        """Return (cached answer or None, cache key, field embedding)"""
+        key = self.cache_key(prompt)
+        cached = self.answer_cache.get(key)
+        embedding = None
+        if cached is None and label:
+            cached, embedding = self.find_similar_answer(label, field_type)
+        return cached, key, embedding
+
+    @staticmethod
+    def field_type(field):
+        return field["type"] or field["tag"]
+
+    def label_cache_args(self, field):
+        """Return the (context hash, label, type) a field's answer is cached under"""
+        # A radio button's label names its option rather than the question,
+        # and a textarea asks for free text that depends on the job
+        if (
+            field["type"] == "radio"
+            or field["tag"] == "textarea"
+            or field["label"] in ("", "Unknown field")
+        ):
+            return None
+        return self.context_hash, field["label"], self.field_type(field)
+
+    def direct_answer(self, field):
+        """Return the profile detail a text field asks for, if it's that simple"""
+        if field["tag"] != "input" or field["type"] not in TEXT_INPUT_TYPES:
+            return None
+        # A visible label decides on its own. An email or tel input, or an id
+        # like "email", can just as well ask for a reference's or manager's.
+        if field["label"] and field["label"] != "Unknown field":
+            candidates = [field["label"]]
+        else:
+            candidates = [field["id"], field["name"]]
+        for text in candidates:
+            words = self.field_words(text)
+            keys = [
+                key
+                for key, pattern in PROFILE_FIELD_PATTERNS.items()
+                if pattern.fullmatch(words)
+            ]
+            if keys:
+                key = PROFILE_INPUT_TYPES.get(field["type"])
+                return self.profile.get(key if key in keys else keys[0])
+        return None
+
+    @staticmethod
+    def field_words(text):
+        """Lowercase the words of a label, id or name, separated by single spaces"""
+        text = CAMEL_CASE_RE.sub(r"\1 \2", text).lower()
+        return " ".join(
+            word for word in WORD_RE.findall(text) if word not in FIELD_MARKER_WORDS
+        )
+
+    def cached_field_answer(self, field):
+        """Return the short answer given to a field with the same label, if any"""
+        args = self.label_cache_args(field)
+        answer = self.answer_cache.get_label(*args) if args else None
+        if answer is None or len(answer) > MAX_LABEL_ANSWER_LENGTH:
+            return None
+        return answer
+
+    @staticmethod
+    def answer_tokens(field):
+        return FIELD_ANSWER_TOKENS.get(field["type"]) or FIELD_ANSWER_TOKENS.get(
+            field["tag"]
+        )
+
+    def query_model(
+        self,
+        prompt,
+        element=None,
+        label=None,
+        fresh=False,
+        max_tokens=None,
+        field_type=None,
+    ):
+        # A fresh answer must differ from the cached one, so it is sampled
+        generation_method = None
+        if fresh:
+            cached, key, embedding = None, self.cache_key(prompt), None
+            generation_method = REGENERATION_METHOD
+        else:
+            cached, key, embedding = self.lookup_answer(prompt, label, field_type)
+        if cached is not None:
+            if element:
+                self.driver.execute_script(APPEND_VALUE_JS, element, cached)
+            return cached
 
-    def query_model(self, prompt, element=None):
         if element:
-            return self.model_interface.stream_generate(
-                prompt, lambda x: element.send_keys(x)
+            writer = ElementStreamWriter(self.driver, element)
+            response = self.model_interface.stream_generate(
+                prompt,
+                writer.write,
+                self.system_prompt,
+                self.application_history(),
+                max_tokens,
+                generation_method,
+            )
+            writer.flush()
+        else:
+            response = self.model_interface.generate(
+                prompt,
+                self.system_prompt,
+                self.application_history(),
+                max_tokens,
+                generation_method,
+            )
+        self.cache_answer(key, response, embedding, field_type)
+        return response
+
+    def generate_many(self, prompts, token_limits):
+        """Generate answers for several prompts concurrently, in prompt order"""
+        history = self.application_history()
+        if self.config["model_type"] != "ollama":
+            # A local HuggingFace model answers every prompt in one padded batch
+            return self.model_interface.generate_batch(
+                prompts, self.system_prompt, history, token_limits
+            )
+
+        # Ollama serves OLLAMA_NUM_PARALLEL requests at once
+        with ThreadPoolExecutor(max_workers=OLLAMA_NUM_PARALLEL) as executor:
+            futures = [
+                executor.submit(
+                    self.model_interface.generate,
+                    prompt,
+                    self.system_prompt,
+                    history,
+                    max_tokens,
+                )
+                for prompt, max_tokens in zip(prompts, token_limits)
+            ]
+            return [future.result() for future in futures]
+
+    def batch_answer_tokens(self, fields, prompt):
+        """Token budget for answering every field in one JSON object
+
+        The budget is capped to the model's context left after the prompt, so
+        the prompt is never cut off to make room for the answer.
+        """
+        answer_tokens = sum(
+            (self.answer_tokens(field) or MAX_ANSWER_TOKENS) + JSON_TOKENS_PER_FIELD
+            for field in fields
+        )
+        prompt_chars = (
+            len(self.system_prompt)
+            + len(prompt)
+            + sum(len(message["content"]) for message in self.application_history())
+        )
+        return min(
+            answer_tokens, MODEL_CONTEXT_TOKENS - prompt_chars // CHARS_PER_TOKEN
+        )
+
+    def query_model_batch(self, fields):
+        prompt = self.create_batch_prompt(fields)
+        key = self.cache_key(prompt)
+        response = self.answer_cache.get(key)
+        if response is None:
+            max_tokens = self.batch_answer_tokens(fields, prompt)
+            if max_tokens < len(fields) * JSON_TOKENS_PER_FIELD:
+                print("The form is too large to answer in one request.")
+                return None
+            response = self.model_interface.generate_json(
+                prompt,
+                self.system_prompt,
+                self.application_history(),
+                self.create_batch_schema(fields),
+                max_tokens,
             )
-        return self.model_interface.generate(prompt)
+        try:
+            answers = json.loads(response)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(answers, dict):
+            return None
+        self.cache_answer(key, response)
+        return answers
 
     def fill_all_fields(self):
-        self.switch_to_latest_tab()
-        form_html = self.get_form_html()
-        if not form_html:
+        # Switches to the latest tab itself
+        form = self.get_form_element()
+        if form is None:
             return
 
-        input_elements = self.extract_input_elements(form_html)
+        try:
+            fields = self.collect_form_fields(form)
+        except Exception as e:
+            print(f"Error collecting form fields: {e}")
+            fields = None
+
+        # Radio buttons are answered per group rather than per input
+        radio_fields = []
+        unanswered = []
+        for field in fields or []:
+            if field["type"] == "radio":
+                radio_fields.append(field)
+                continue
+
+            # Fields like email and phone are answered without the model
+            cached = self.direct_answer(field) or self.cached_field_answer(field)
+            if cached is not None:
+                self.fill_answer(field, cached)
+            else:
+                unanswered.append(field)
+
+        # Only ask about the first of several fields with the same label
+        unanswered, duplicates = self.split_duplicate_fields(unanswered)
+
+        # Embed every remaining field in one request for the semantic lookup
+        batch_fields = []
+        similar = self.find_similar_answers(unanswered)
+        for field, (cached, embedding) in zip(unanswered, similar):
+            field["embedding"] = embedding
+            if cached is not None:
+                self.fill_answer(field, cached)
+            else:
+                batch_fields.append(field)
+
+        # Radio groups go in the same request, listing their options
+        radio_groups = self.radio_group_fields(radio_fields)
+
+        answers = {}
+        if batch_fields or radio_groups:
+            answers = self.query_model_batch(batch_fields + radio_groups)
+        if fields is None or answers is None:
+            print("Could not fill the form in one request. Filling fields one by one.")
+            remaining = (
+                None if fields is None else batch_fields + duplicates + radio_fields
+            )
+            self.fill_fields_individually(form, remaining)
+            return
+
+        for index, field in enumerate(batch_fields + radio_groups, start=1):
+            response = answers.get(str(index))
+            if response is None:
+                print(f"No answer returned for field '{field['label']}'")
+                continue
+            response = str(response)
+            if "radios" in field:
+                self.add_to_application_context(field["label"], response)
+                radios = field["radios"]
+                try:
+                    self.click_best_radio(
+                        [radio["element"] for radio in radios],
+                        [radio["value"] for radio in radios],
+                        [radio["label"] for radio in radios],
+                        response,
+                        field["label"],
+                    )
+                except Exception as e:
+                    print(f"Error processing radio group {field['name']}: {e}")
+                continue
+            if field["embedding"] is not None and response:
+                self.semantic_cache.add(
+                    field["embedding"],
+                    response,
+                    self.context_hash,
+                    self.field_type(field),
+                )
+            self.fill_answer(field, response)
+
+        self.fill_duplicate_fields(duplicates)
+
+    def radio_group_fields(self, radio_fields):
+        """Combine radio button fields into one field per group with its options"""
+        groups = {}
+        for field in radio_fields:
+            if field["name"]:
+                groups.setdefault(field["name"], []).append(field)
+        return [
+            {
+                **radios[0],
+                "label": radios[0]["group"] or radios[0]["label"],
+                "options": [radio["label"] or radio["value"] for radio in radios],
+                "radios": radios,
+            }
+            for radios in groups.values()
+        ]
+
+    def split_duplicate_fields(self, fields):
+        """Split fields into the first with each label and the repeats after it"""
+        unique = []
+        duplicates = []
+        seen = set()
+        for field in fields:
+            args = self.label_cache_args(field)
+            key = AnswerCache.label_key(*args[1:]) if args else None
+            if key in seen:
+                duplicates.append(field)
+                continue
+            if key:
+                seen.add(key)
+            unique.append(field)
+        return unique, duplicates
+
+    def fill_duplicate_fields(self, duplicates):
+        # Filling the first field with a label recorded its answer for the
+        # rest, even one too long for the label cache
+        for field in duplicates:
+            answers = self.answer_history.get(field["label"])
+            cached = self.cached_field_answer(field) or (
+                answers[-1] if answers else None
+            )
+            if cached is not None:
+                self.fill_answer(field, cached)
+            else:
+                print(f"No answer returned for field '{field['label']}'")
+
+    def fill_radio_groups(self, radio_fields):
+        radio_names = []
+        for field in radio_fields:
+            if field["name"] and field["name"] not in radio_names:
+                radio_names.append(field["name"])
 
-        for element_html in input_elements:
-            element_type = re.search(r"<(\w+)", element_html).group(1)
-            element_id = re.search(r' id=[\'"]([^\'"]*)[\'"]', element_html)
-            element_id = element_id.group(1) if element_id else None
-            element_name = re.search(r' name=[\'"]([^\'"]*)[\'"]', element_html)
-            element_name = element_name.group(1) if element_name else None
+        for name in radio_names:
+            try:
+                self.handle_radio_group(name)
+            except Exception as e:
+                print(f"Error processing radio group {name}: {e}")
+
+    def add_to_application_context(self, label, response):
+        self.current_application_context.append((label, response))
+        self.application_messages.append(
+            {"role": "user", "content": f"Field '{label}'"}
+        )
+        self.application_messages.append({"role": "assistant", "content": response})
+        self.history_tokens += self.history_entry_tokens(label, response)
+        # Drop the oldest answers once the history outgrows its budget, so the
+        # prompt still fits in the room RESERVED_PROMPT_TOKENS leaves for it
+        while self.history_tokens > HISTORY_TOKEN_BUDGET:
+            old_label, old_response = self.current_application_context.pop(0)
+            del self.application_messages[:2]
+            self.history_tokens -= self.history_entry_tokens(old_label, old_response)
+
+    @staticmethod
+    def history_entry_tokens(label, response):
+        """Estimated tokens of one answer's pair of history messages"""
+        return (len(label) + len(response) + len("Field ''")) // CHARS_PER_TOKEN
+
+    def record_answer(self, label, response):
+        # Keep the alternatives given in earlier sessions to go back to
+        self.add_alternative_answer(label, response)
+        self.add_to_application_context(label, response)
+
+    def cache_label_answer(self, field, response):
+        """Make this the answer served to the field's label on later fills"""
+        args = self.label_cache_args(field)
+        if (
+            args
+            and response
+            and response != OLLAMA_ERROR_RESPONSE
+            and len(response) <= MAX_LABEL_ANSWER_LENGTH
+        ):
+            self.answer_cache.put_label(*args, response)
+
+    def fill_answer(self, field, response):
+        self.record_answer(field["label"], response)
+        self.cache_label_answer(field, response)
+        try:
+            self.fill_field(field, response)
+        except Exception as e:
+            print(f"Error processing element {field['id'] or field['name']}: {e}")
+
+    def fields_from_html(self, form_html):
+        """Locate the form's fields one at a time from its HTML
+
+        Slower fallback for when the fields can't be collected with one script.
+        """
+        fields = []
+        for element_type, attributes in self.extract_input_elements(form_html):
+            element_id = attributes.get("id", "")
+            element_name = attributes.get("name", "")
+            input_type = attributes.get("type", "").lower()
 
             if not element_id and not element_name:
                 continue
 
+            field = {
+                "tag": element_type,
+                "type": input_type,
+                "id": element_id,
+                "name": element_name,
+                "placeholder": "",
+                "label": "",
+                "html": "",
+                "element": None,
+            }
+            if element_type == "input" and input_type == "radio":
+                fields.append(field)
+                continue
+
+            # Skip file uploads, buttons and other inputs the model can't fill
+            if input_type in SKIPPED_INPUT_TYPES:
+                print(f"Skipping {input_type} field: {element_id or element_name}")
+                continue
+
             try:
-                if element_type == "input" and re.search(
-                    r' type=[\'"]radio[\'"]', element_html
-                ):
-                    self.handle_radio_group(element_name)
+                if element_id:
+                    selenium_element = self.driver.find_element(By.ID, element_id)
                 else:
-                    if element_id:
-                        selenium_element = self.driver.find_element(By.ID, element_id)
-                    elif element_name:
-                        selenium_element = self.driver.find_element(
-                            By.NAME, element_name
-                        )
-
-                    # Check if the element is visible and enabled
-                    if (
-                        not selenium_element.is_displayed()
-                        or not selenium_element.is_enabled()
-                    ):
-                        print(
-                            f"Skipping hidden or disabled element: {element_id or element_name}"
-                        )
-                        continue
-
-                    # Skip file inputs
-                    if selenium_element.get_attribute("type") == "file":
-                        print(
-                            f"Skipping file upload field: {element_id or element_name}"
-                        )
-                        continue
-
-                    label = self.get_field_label(selenium_element)
-                    print(f"Now processing input with label '{label}'....")
-
-                    prompt = self.create_prompt(
-                        form_html, element_type, element_id or element_name, label
+                    selenium_element = self.driver.find_element(By.NAME, element_name)
+
+                # Read visibility, label and surrounding HTML in one command
+                info = self.driver.execute_script(
+                    COLLECT_FIELDS_JS, [selenium_element]
+                )[0]
+                if not info["visible"] or not info["enabled"]:
+                    print(
+                        f"Skipping hidden or disabled element: {element_id or element_name}"
                     )
-                    response = self.query_model(prompt)
-                    self.answer_history[label] = [response]
-
-                    self.fill_field(selenium_element, response, label)
+                    continue
 
+                field["element"] = selenium_element
+                field["label"] = info["label"]
+                field["html"] = info["html"]
+                fields.append(field)
             except Exception as e:
                 print(f"Error processing element {element_id or element_name}: {e}")
+        return fields
+
+    def fill_fields_individually(self, form, fields=None):
+        if fields is None:
+            fields = self.fields_from_html(form.get_attribute("outerHTML"))
+
+        # Build every field's prompt first so the model can answer them
+        # concurrently, then fill the fields from the main thread since
+        # Selenium isn't thread-safe
+        radio_fields = [field for field in fields if field["type"] == "radio"]
+        fields, duplicates = self.split_duplicate_fields(
+            [field for field in fields if field["type"] != "radio"]
+        )
+        pending = []
+        for field in fields:
+            label = field["label"]
+            print(f"Now processing input with label '{label}'....")
+            cached = self.direct_answer(field) or self.cached_field_answer(field)
+            if cached is not None:
+                self.fill_answer(field, cached)
+                continue
+
+            prompt = self.create_prompt(
+                field["html"], field["tag"], field["id"] or field["name"], label
+            )
+            cached, key, embedding = self.lookup_answer(
+                prompt, label, self.field_type(field)
+            )
+            if cached is not None:
+                self.fill_answer(field, cached)
+            else:
+                pending.append((field, prompt, key, embedding))
+
+        responses = []
+        if pending:
+            prompts = [prompt for _, prompt, _, _ in pending]
+            token_limits = [self.answer_tokens(field) for field, _, _, _ in pending]
+            responses = self.generate_many(prompts, token_limits)
+
+        for (field, _, key, embedding), response in zip(pending, responses):
+            self.cache_answer(key, response, embedding, self.field_type(field))
+            self.fill_answer(field, response)
+
+        self.fill_duplicate_fields(duplicates)
+        self.fill_radio_groups(radio_fields)
 
     def handle_radio_group(self, name):
         if not name:
@@ -209,59 +1147,70 @@ class JobApplicationAutofill:
             print(f"No radio buttons found for group: {name}")
             return
 
-        # Get the label for the radio group
-        group_label = self.get_field_label(radio_group[0])
+        # Read every button's label, value and surrounding HTML at once
+        radios = self.driver.execute_script(COLLECT_FIELDS_JS, radio_group)
+        group_label = radios[0]["group"] or radios[0]["label"]
         print(f"Now processing input with label '{group_label}'....")
 
         # Create prompt and get response
-        prompt = self.create_prompt(self.get_form_html(), "radio", name, group_label)
-        response = self.query_model(prompt)
+        prompt = self.create_prompt(radios[0]["html"], "radio", name, group_label)
+        response = self.query_model(
+            prompt,
+            label=group_label,
+            max_tokens=FIELD_ANSWER_TOKENS["radio"],
+            field_type="radio",
+        )
+        self.add_to_application_context(group_label, response)
+
+        self.click_best_radio(
+            radio_group,
+            [radio["value"] for radio in radios],
+            [radio["label"] for radio in radios],
+            response,
+            group_label,
+        )
 
-        # Find the best matching radio button
+    def click_best_radio(self, radios, values, labels, response, group_label):
+        """Click the radio button whose value or label best matches the answer"""
+        # Each radio button can match on either its value or its label
+        choices = []
+        for value, label in zip(values, labels):
+            choices.extend((value.lower(), label.lower()))
         best_match = None
-        best_match_score = float("inf")
-        for radio in radio_group:
-            radio_value = radio.get_attribute("value").lower()
-            radio_label = self.get_field_label(radio).lower()
-
-            score = min(
-                self.levenshtein_distance(radio_value, response.lower()),
-                self.levenshtein_distance(radio_label, response.lower()),
-            )
-
-            if score < best_match_score:
-                best_match = radio
-                best_match_score = score
+        if choices:
+            index = self.closest_choice(choices, response.lower()) // 2
+            best_match = radios[index]
+            best_match_value = values[index]
 
         if best_match:
             best_match.click()
-            print(
-                f"Radio group '{group_label}' filled with: {best_match.get_attribute('value')}"
-            )
+            print(f"Radio group '{group_label}' filled with: {best_match_value}")
         else:
             print(
                 f"No suitable match found for radio group '{group_label}': {response}"
             )
 
-    def fill_field(self, element, response, label):
-        element_type = element.get_attribute("type")
-
-        if element.tag_name == "select":
+    def fill_field(self, field, response):
+        # The field's tag and type were read when it was collected
+        element = field["element"]
+        label = field["label"]
+        if field["tag"] == "select":
             self.handle_select(element, response, label)
-        elif element_type == "checkbox":
+        elif field["type"] == "checkbox":
             self.handle_checkbox(element, response, label)
         else:  # text, textarea, etc.
             self.handle_text_input(element, response, label)
 
     def handle_select(self, element, response, label):
         select = Select(element)
-        options = [option.text.strip().lower() for option in select.options]
+        options = [option.text.strip() for option in select.options]
         response_lower = response.strip().lower()
 
-        best_match = min(
-            options, key=lambda x: self.levenshtein_distance(x, response_lower)
+        index = self.closest_choice(
+            [option.lower() for option in options], response_lower
         )
-        select.select_by_visible_text(best_match)
+        best_match = options[index]
+        select.select_by_index(index)
         print(f"Field '{label}' (select) filled with: {best_match}")
 
     def handle_checkbox(self, element, response, label):
@@ -278,13 +1227,32 @@ class JobApplicationAutofill:
             print(f"Invalid response for checkbox '{label}': {response}")
 
     def handle_text_input(self, element, response, label):
-        element.clear()
-        element.send_keys(response)
+        self.set_value(element, response)
         print(f"Field '{label}' filled with: {response}")
 
-    def levenshtein_distance(self, s1, s2):
+    def set_value(self, element, text):
+        self.driver.execute_script(SET_VALUE_JS, element, text)
+
+    def closest_choice(self, choices, response):
+        """Return the index of the choice with the smallest edit distance"""
+        # Answers constrained to the options match one exactly
+        if response in choices:
+            return choices.index(response)
+        if extractOne is not None:
+            return extractOne(response, choices, scorer=Levenshtein.distance)[2]
+        best_index = 0
+        best_distance = None
+        for index, choice in enumerate(choices):
+            distance = self.levenshtein_distance(choice, response, best_distance)
+            if best_distance is None or distance < best_distance:
+                best_index = index
+                best_distance = distance
+        return best_index
+
+    def levenshtein_distance(self, s1, s2, cutoff=None):
+        """Return the edit distance, or cutoff + 1 once it must exceed cutoff"""
         if len(s1) < len(s2):
-            return self.levenshtein_distance(s2, s1)
+            s1, s2 = s2, s1
         if len(s2) == 0:
             return len(s1)
         previous_row = range(len(s2) + 1)
@@ -295,91 +1263,88 @@ class JobApplicationAutofill:
                 deletions = current_row[j] + 1
                 substitutions = previous_row[j] + (c1 != c2)
                 current_row.append(min(insertions, deletions, substitutions))
+            # Row minimums never decrease, so the distance is at least this
+            if cutoff is not None and min(current_row) > cutoff:
+                return cutoff + 1
             previous_row = current_row
         return previous_row[-1]
 
-    def get_field_label(self, element):
-        label_text = None
-
-        # Method 1: Check for 'id' attribute and corresponding label
-        element_id = element.get_attribute("id")
-        if element_id:
-            try:
-                label = self.driver.find_element(
-                    By.CSS_SELECTOR, f"label[for='{element_id}']"
-                )
-                label_text = label.text.strip()
-                if label_text:
-                    return label_text
-            except NoSuchElementException:
-                pass
-
-        # Method 2: Check for a label that's a parent of the input
-        try:
-            label = element.find_element(By.XPATH, "ancestor::label")
-            label_text = label.text.strip()
-            if label_text:
-                return label_text
-        except NoSuchElementException:
-            pass
-
-        # Method 3: Look for the closest preceding label
-        try:
-            label = element.find_element(By.XPATH, "preceding::label[1]")
-            label_text = label.text.strip()
-            if label_text:
-                return label_text
-        except NoSuchElementException:
-            pass
-
-        # Method 4: Look for a label or div with class containing 'label' right before the input
-        try:
-            label = element.find_element(
-                By.XPATH,
-                "./preceding-sibling::*[self::label or contains(@class, 'label')][1]",
-            )
-            label_text = label.text.strip()
-            if label_text:
-                return label_text
-        except NoSuchElementException:
-            pass
-
-        # Fallback methods
-        label_text = (
-            element.get_attribute("aria-label")
-            or element.get_attribute("placeholder")
-            or element.get_attribute("name")
-            or "Unknown field"
+    def create_system_prompt(self):
+        return (
+            f"Job applicant information:\n{self.context}\n\n"
+            "You are an assistant to the job applicant with the information given above. You are using the information given about the job applicant to fill in the fields of a job application form."
         )
 
-        return label_text
+    def application_history(self):
+        """Return the answers given so far in this application as chat messages"""
+        return self.application_messages
+
+    def create_prompt(self, field_html, element_type, element_id, label):
+        # Regenerating an answer for the same unchanged field reuses the
+        # prompt built last time instead of rebuilding it
+        key = (element_type, element_id, label)
+        cached = self.last_prompts.get(key)
+        if cached and cached[0] == field_html:
+            return cached[1]
+
+        # Only the HTML around the field is sent, rather than the whole form,
+        # to keep prefill short. The instructions go first so they stay
+        # byte-identical across fields and Ollama's prompt cache can reuse them.
+        prompt = (
+            FIELD_PROMPT_INSTRUCTIONS
+            + f"Field HTML:\n{field_html}\n\n"
+            + f"Field: {element_type} id={element_id} label={label}\nAnswer:"
+        )
+        self.last_prompts[key] = (field_html, prompt)
+        return prompt
+
+    def create_batch_prompt(self, fields):
+        field_lines = []
+        for index, field in enumerate(fields, start=1):
+            attributes = {
+                key: field[key]
+                for key in ("tag", "type", "id", "name", "placeholder", "options")
+                if field.get(key)
+            }
+            field_lines.append(
+                f"[{index}] Label: {field['label']} Attrs: {json.dumps(attributes)}"
+            )
 
-    def create_prompt(self, form_html, element_type, element_id, label):
+        # Each field's label, attributes and options stand in for the form's
+        # HTML, which is far longer
         return (
-            f"Job applicant information:\n{self.context}\n\n"
-            f"Current form HTML:\n{form_html}\n\n"
-            "You are an assistant to the job applicant with the information given above. You are using the information given about the job applicant to fill in a field in the form given above. "
-            f"Respond with exactly what the job applicant would say in response for the {element_type} field with ID '{element_id}' and label '{label}'. "
-            "Consider the field's type and label, and the current state of the form. Note that your whole and complete response will be filled in as the input field's value, meaning only respond with exactly what the job applicant would say. Keep the answer concise and relevant to the field type and context.\n"
-            f"Response to insert into {element_type} field with ID '{element_id}' and label '{label}': "
+            "Fill in every field of the job application form listed below. "
+            "Respond with exactly what the job applicant would say for each field. For checkboxes respond with 'yes' or 'no', and for select fields and fields with options respond with the option text to choose. Keep each answer concise and relevant to the field type and context.\n"
+            'Return strict JSON mapping each field index to its answer, e.g. {"1": "...", "2": "..."}.\n'
+            + "\n".join(field_lines)
         )
 
+    def create_batch_schema(self, fields):
+        """JSON schema for a batch answer, limiting fields with options to them"""
+        properties = {}
+        for index, field in enumerate(fields, start=1):
+            properties[str(index)] = {"type": "string"}
+            if field.get("options"):
+                properties[str(index)]["enum"] = field["options"]
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+        }
+
     def change_answer(self, direction):
         self.switch_to_latest_tab()
-        current_element = self.driver.switch_to.active_element
-        if not current_element.is_displayed() or not current_element.is_enabled():
+        # Fetch the focused field and everything needed about it at once
+        current_element, info = self.driver.execute_script(ACTIVE_FIELD_JS)
+        if not info["visible"] or not info["enabled"]:
             print("Current element is not visible or enabled. Cannot change answer.")
             return
 
-        label = self.get_field_label(current_element)
+        label = info["label"]
         print(f"Now processing input with label '{label}'....")
         if label in self.answer_history:
-            current_value = current_element.get_attribute("value")
-            current_index = (
-                self.answer_history[label].index(current_value)
-                if current_value in self.answer_history[label]
-                else -1
-            )
+            current_value = info["value"]
+            current_index = self.answer_positions[label].get(current_value, -1)
 
             if direction == "previous":
                 new_index = max(0, current_index - 1)
@@ -390,17 +1355,26 @@ class JobApplicationAutofill:
                     new_answer = self.answer_history[label][new_index]
                 else:
                     # Generate a new answer
-                    form_html = self.get_form_html()
-                    element_id = current_element.get_attribute("id")
-                    element_type = current_element.tag_name
                     prompt = self.create_prompt(
-                        form_html, element_type, element_id, label
+                        info["html"], info["tag"], info["id"], label
                     )
-                    new_answer = self.query_model(prompt)
-                    self.answer_history[label].append(new_answer)
-
-            current_element.clear()
-            current_element.send_keys(new_answer)
+                    # Stream the new answer straight into the field
+                    self.set_value(current_element, "")
+                    new_answer = self.query_model(
+                        prompt,
+                        element=current_element,
+                        fresh=True,
+                        max_tokens=self.answer_tokens(info),
+                    )
+                    self.add_alternative_answer(label, new_answer)
+                    self.add_to_application_context(label, new_answer)
+                    self.cache_label_answer(info, new_answer)
+                    print(f"Answer changed to: {new_answer}")
+                    return
+
+            self.set_value(current_element, new_answer)
+            # The answer the user moved away from shouldn't be served again
+            self.cache_label_answer(info, new_answer)
             print(f"Answer changed to: {new_answer}")
         else:
             print("No previous answers for this field.")
@@ -412,6 +1386,11 @@ class JobApplicationAutofill:
         self.change_answer("next")
 
     def set_model(self):
+        previous_settings = (
+            self.config["model_type"],
+            self.config["ollama_model_name"],
+            self.config["hf_model_name"],
+        )
         print("\nChoose model type:")
         print("1. Ollama")
         print("2. HuggingFace")
@@ -421,12 +1400,13 @@ class JobApplicationAutofill:
             if choice == "1":
                 self.config["model_type"] = "ollama"
                 new_model = input(
-                    f"Current Ollama model: {self.config.get('ollama_model_name', 'llama3.2')}.\n"
+                    f"Current Ollama model: {self.config.get('ollama_model_name', 'llama3.2:3b-instruct-q4_K_M')}.\n"
                     "Enter a new model name or press Enter to keep current: "
                 )
                 if new_model:
                     self.config["ollama_model_name"] = new_model
-                self._pull_ollama_model()
+                self._pull_ollama_model(self.config["ollama_model_name"])
+                self._pull_ollama_model(OLLAMA_EMBEDDING_MODEL)
                 break
             elif choice == "2":
                 self.config["model_type"] = "huggingface"
@@ -435,32 +1415,55 @@ class JobApplicationAutofill:
                     "Enter new model path or press Enter to keep current: "
                 )
                 if new_model:
-                    self.config["model_name"] = new_model
+                    self.config["hf_model_name"] = new_model
                 break
             else:
                 print("Invalid choice. Please enter 1 or 2.")
 
-        match self.config["model_type"]:
-            case "ollama":
-                self.model_interface = get_model_interface(
-                    "ollama", self.config["ollama_model_name"]
-                )
-            case "huggingface":
-                self.model_interface = get_model_interface(
-                    "huggingface", self.config["hf_model_name"]
-                )
+        if self.model_interface:
+            self.model_interface.close()
+
+        self.model_interface = get_model_interface(
+            self.config["model_type"], self.current_model_name()
+        )
+        self.model_interface.generation_method = self.generation_method()
+        # Load the model in the background while the browser starts and the
+        # user navigates to a form
+        threading.Thread(
+            target=self.model_interface.warm_up, args=(self.system_prompt,), daemon=True
+        ).start()
+
+        if previous_settings != (
+            self.config["model_type"],
+            self.config["ollama_model_name"],
+            self.config["hf_model_name"],
+        ):
+            self.config_dirty = True
+
+    def set_generation_method(self):
+        methods = list(GENERATION_METHODS)
+        print("\nChoose generation method:")
+        for index, method in enumerate(methods, start=1):
+            print(f"{index}. {method.capitalize()}")
 
-        self.save_config()
+        while True:
+            choice = input(f"Enter choice (1-{len(methods)}): ")
+            if choice.isdigit() and 1 <= int(choice) <= len(methods):
+                method = methods[int(choice) - 1]
+                break
+            print(f"Invalid choice. Please enter a number from 1 to {len(methods)}.")
+
+        if method != self.generation_method():
+            self.config["generation_method"] = method
+            self.config_dirty = True
+        self.model_interface.generation_method = method
+        print(f"Using {method} generation.")
 
-    def _pull_ollama_model(self):
-        print(f"Pulling Ollama model: {self.config['ollama_model_name']}")
+    def _pull_ollama_model(self, model_name):
+        print(f"Pulling Ollama model: {model_name}")
         try:
-            subprocess.run(
-                ["ollama", "pull", self.config["ollama_model_name"]], check=True
-            )
-            print(
-                f"Successfully pulled Ollama model: {self.config['ollama_model_name']}"
-            )
+            subprocess.run(["ollama", "pull", model_name], check=True)
+            print(f"Successfully pulled Ollama model: {model_name}")
         except subprocess.CalledProcessError as e:
             print(f"Error pulling Ollama model: {e}")
         except FileNotFoundError:
@@ -470,6 +1473,28 @@ class JobApplicationAutofill:
         except Exception as e:
             print(f"Uncaught error while pulling model: {e}")
 
+    def run_cancellable(self, command):
+        """Run a command, letting Ctrl+C stop its generation instead of exiting
+
+        Ctrl+C while no generation is in progress interrupts as usual.
+        """
+        model_interface = self.model_interface
+
+        def interrupt(signum, frame):
+            if model_interface.is_generating():
+                model_interface.cancel_event.set()
+            else:
+                signal.default_int_handler(signum, frame)
+
+        previous_handler = signal.signal(signal.SIGINT, interrupt)
+        try:
+            command()
+        except GenerationCancelled:
+            print("\nGeneration cancelled.")
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            model_interface.cancel_event.clear()
+
     def print_commands(self):
         print("\nAvailable commands:")
         print("n: Start a new application")
@@ -477,42 +1502,60 @@ class JobApplicationAutofill:
         print("p: Use previous answer for the current visible field")
         print("x: Use next answer or generate a new one for the current visible field")
         print("m: Change model settings")
+        print("g: Change generation method")
         print("q: Quit the program")
+        print("r: Clear all cached answers")
+        print("c: Close the browser and quit the program")
         print("h: Show this help message")
+        print("Press Ctrl+C while answers are being generated to stop them.")
 
     def run(self):
-        self.load_context_file()
-        self.set_model()
-        self.setup_browser()
-        print(f"Using {self.config['browser'].capitalize()} browser.")
-        self.print_commands()
+        try:
+            self.load_context_file()
+            self.set_model()
+            self.setup_browser()
+            print(f"Using {self.config['browser'].capitalize()} browser.")
+            self.print_commands()
+
+            # Commands that return to the prompt once they are done
+            commands = {
+                "n": self.new_application,
+                "f": lambda: self.run_cancellable(self.fill_all_fields),
+                "p": self.previous_answer,
+                "x": lambda: self.run_cancellable(self.next_answer),
+                "m": self.set_model,
+                "g": self.set_generation_method,
+                "r": self.clear_cache,
+                "h": self.print_commands,
+            }
 
-        while True:
-            try:
-                command = input("\nEnter a command: ").lower()
-                if command == "n":
-                    self.new_application()
-                elif command == "f":
-                    self.fill_all_fields()
-                elif command == "p":
-                    self.previous_answer()
-                elif command == "x":
-                    self.next_answer()
-                elif command == "m":
-                    self.set_model()
-                elif command == "h":
-                    self.print_commands()
-                elif command == "q":
-                    print("Exiting program...")
+            while True:
+                try:
+                    command = input("\nEnter a command: ").lower()
+                    if command in commands:
+                        commands[command]()
+                    elif command == "q":
+                        print("Exiting program...")
+                        break
+                    elif command == "c":
+                        print("Closing the browser and exiting program...")
+                        # Unlike on quit, don't leave Chrome open to reattach to
+                        self.driver.quit()
+                        self.driver = None
+                        break
+                    else:
+                        print("Unknown command. Type 'h' for help.")
+                except KeyboardInterrupt:
+                    print("\nExiting program...")
                     break
-                else:
-                    print("Unknown command. Type 'h' for help.")
-            except KeyboardInterrupt:
-                print("\nExiting program...")
-                break
-
-        if self.driver:
-            self.driver.quit()
+        finally:
+            if self.config_dirty:
+                self.save_config()
+            self.save_answers()
+            if self.model_interface:
+                self.model_interface.close()
+            if self.driver:
+                self.release_browser()
 
 
 if __name__ == "__main__":
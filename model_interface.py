@@ -1,120 +1,884 @@
 from abc import ABC, abstractmethod
-import json
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib.util
+import os
+import queue
+import threading
 import requests
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional
+
+try:
+    # C-accelerated JSON decoding for the streamed NDJSON lines
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Small model used to embed field labels for the semantic answer cache
+OLLAMA_EMBEDDING_MODEL = "nomic-embed-text"
+
+# Number of requests the Ollama server handles concurrently. Must match the
+# OLLAMA_NUM_PARALLEL environment variable the server was started with.
+OLLAMA_NUM_PARALLEL = 4
+
+# Fail fast if the local server isn't running, but never cut off a generation
+OLLAMA_TIMEOUT = (3, None)
+
+# Keep the model (and its prompt KV cache) loaded until the interface is closed,
+# rather than letting Ollama unload it while the user is idle
+OLLAMA_KEEP_ALIVE = -1
+
+# Bytes read from the socket at a time while splitting the NDJSON stream
+STREAM_CHUNK_SIZE = 4096
+
+# Number of tokens of context the models are expected to handle
+MODEL_CONTEXT_TOKENS = 8192
+
+# Cap on the tokens generated for a single field's answer, which is rarely more
+# than a sentence
+MAX_ANSWER_TOKENS = 128
+
+# Cap on the tokens of a whole-form JSON answer when the caller gives no
+# budget of its own
+MAX_JSON_ANSWER_TOKENS = 2048
+
+# Sent with every Ollama request for the answering model. num_ctx must be the
+# same for every request, or Ollama reloads the model to resize its context.
+OLLAMA_OPTIONS = {"num_ctx": MODEL_CONTEXT_TOKENS, "num_predict": MAX_ANSWER_TOKENS}
+
+# Decoding settings for each generation method, as HuggingFace generate()
+# arguments. Greedy decoding is the default: it is the cheapest, and its
+# answers are repeatable, so cached answers match what would be regenerated.
+GENERATION_METHODS = {
+    "greedy": {"do_sample": False},
+    "sampling": {"do_sample": True, "temperature": 0.7, "top_p": 0.9},
+    "beam": {"do_sample": False, "num_beams": 4},
+}
+DEFAULT_GENERATION_METHOD = "greedy"
+
+# The same settings as Ollama options. Ollama has no beam search, so beam
+# decoding falls back to greedy.
+OLLAMA_GENERATION_OPTIONS = {
+    "greedy": {"temperature": 0},
+    "sampling": {"temperature": 0.7, "top_p": 0.9},
+    "beam": {"temperature": 0},
+}
+
+# Where the HuggingFace interface keeps the KV caches of system messages
+# between sessions, and how many of them to keep. A cache for a long context
+# can take hundreds of megabytes.
+PREFIX_KV_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "job_application_autofill", "prefix_kv"
+)
+MAX_PREFIX_KV_FILES = 4
+
+# Rows (prompts times beams) the HuggingFace interface generates at once. Each
+# row gets its own copy of the system message's KV cache, so larger batches
+# are split to keep those copies within GPU memory.
+MAX_BATCH_ROWS = 4
+
+# Seconds a HuggingFace stream waits for its next token before checking whether
+# it was cancelled, since the first token can take a long prompt's prefill
+STREAM_POLL_INTERVAL = 0.5
+
+# Separates the system message, each history message and the prompt in a
+# HuggingFace prompt. Tokenizers don't merge tokens across it, so the parts
+# after it can be tokenized one at a time.
+PROMPT_SEPARATOR = "\n\n"
+
+# Returned in place of an answer when the Ollama server can't be reached
+OLLAMA_ERROR_RESPONSE = "Error querying Ollama"
+
+
+class GenerationCancelled(BaseException):
+    """Raised from a generation when its interface's cancel_event is set
+
+    Like KeyboardInterrupt, it derives from BaseException so the per-field
+    error handling doesn't swallow it.
+    """
 
 
 class ModelInterface(ABC):
     """Abstract base class for model interfaces"""
 
+    def __init__(self):
+        # Set to stop every generation in progress, from any thread
+        self.cancel_event = threading.Event()
+        # Number of generations in progress, across threads
+        self._generations = 0
+        self._generations_lock = threading.Lock()
+        # One of GENERATION_METHODS
+        self.generation_method = DEFAULT_GENERATION_METHOD
+
+    def _check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise GenerationCancelled()
+
+    @contextlib.contextmanager
+    def _generating(self):
+        """Count the generation run in the block as in progress"""
+        with self._generations_lock:
+            self._generations += 1
+        try:
+            yield
+        finally:
+            with self._generations_lock:
+                self._generations -= 1
+
+    def is_generating(self) -> bool:
+        """Whether a generation that cancel_event would stop is in progress"""
+        return self._generations > 0
+
     @abstractmethod
-    def generate(self, prompt: str) -> str:
-        """Generate text response from the model"""
+    def generate(
+        self,
+        prompt: str,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
+        """Generate text response from the model
+
+        The optional system message and chat history (a list of
+        {"role", "content"} messages) come before the prompt. The answer is
+        cut off after max_tokens tokens, or the interface's default limit.
+        generation_method overrides the interface's generation_method for
+        this answer.
+        """
         pass
 
     @abstractmethod
-    def stream_generate(self, prompt: str, callback) -> str:
+    def stream_generate(
+        self,
+        prompt: str,
+        callback,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
         """Generate text response from the model with streaming"""
         pass
 
+    def generate_batch(
+        self,
+        prompts: List[str],
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        token_limits: Optional[List[Optional[int]]] = None,
+    ) -> List[str]:
+        """Generate a response to each prompt, in prompt order
+
+        token_limits optionally gives each prompt's max_tokens.
+        """
+        token_limits = token_limits or [None] * len(prompts)
+        return [
+            self.generate(prompt, system, history, max_tokens)
+            for prompt, max_tokens in zip(prompts, token_limits)
+        ]
+
+    def generate_json(
+        self,
+        prompt: str,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        schema: Optional[dict] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """Generate a JSON-formatted text response from the model
+
+        Interfaces that support constrained decoding make the response match
+        the optional JSON schema. A JSON answer covers several fields, so it
+        gets its own max_tokens budget, MAX_JSON_ANSWER_TOKENS by default.
+        """
+        return self.generate(
+            prompt, system, history, max_tokens or MAX_JSON_ANSWER_TOKENS
+        )
+
+    def embed(self, text: str) -> Optional[List[float]]:
+        """Embed text for similarity lookups, or None if unsupported"""
+        return None
+
+    def embed_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Embed several texts, in order"""
+        return [self.embed(text) for text in texts]
+
+    def warm_up(self, system: Optional[str] = None):
+        """Load the model ahead of the first request
+
+        Interfaces with a prompt cache also process the optional system
+        message, so the first real request only has to process its own part.
+        """
+        pass
+
+    def close(self):
+        """Release any resources held by the interface"""
+        pass
+
 
 class OllamaInterface(ModelInterface):
-    def __init__(self, model_name: str):
+    def __init__(
+        self, model_name: str, embedding_model_name: str = OLLAMA_EMBEDDING_MODEL
+    ):
+        super().__init__()
         self.model_name = model_name
+        self.embedding_model_name = embedding_model_name
         self.base_url = "http://localhost:11434/api"
+        # Reuse one keep-alive connection pool for every request to the server
+        self.session = requests.Session()
+        self.session.mount(
+            "http://",
+            # One pooled connection per concurrent request to the local server
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=OLLAMA_NUM_PARALLEL,
+                max_retries=0,
+            ),
+        )
+        self.session.headers.update({"Connection": "keep-alive"})
 
-    def generate(self, prompt: str) -> str:
-        url = f"{self.base_url}/generate"
-        data = {"model": self.model_name, "prompt": prompt}
+    def _chat_data(
+        self,
+        prompt: str,
+        system: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        options: Optional[dict] = None,
+        generation_method: Optional[str] = None,
+        **kwargs,
+    ) -> dict:
+        # Keep the system message first and byte-identical between calls so
+        # Ollama can reuse the KV cache of that shared prefix
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.extend(history or [])
+        messages.append({"role": "user", "content": prompt})
+        return {
+            "model": self.model_name,
+            "messages": messages,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {
+                **OLLAMA_OPTIONS,
+                **OLLAMA_GENERATION_OPTIONS[
+                    generation_method or self.generation_method
+                ],
+                **(options or {}),
+            },
+            **kwargs,
+        }
+
+    @staticmethod
+    def _token_options(max_tokens: Optional[int]) -> Optional[dict]:
+        return {"num_predict": max_tokens} if max_tokens else None
 
+    def _chat(self, data: dict) -> str:
+        """Send a non-streaming chat request and return the whole reply"""
+        self._check_cancelled()
         try:
-            with requests.post(url, json=data, stream=True) as response:
-                response.raise_for_status()
-                full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        json_response = json.loads(line)
-                        if "response" in json_response:
-                            full_response += json_response["response"]
-                return full_response
+            response = self.session.post(
+                f"{self.base_url}/chat", json=data, timeout=OLLAMA_TIMEOUT
+            )
+            response.raise_for_status()
+            return json_loads(response.content).get("message", {}).get("content", "")
         except requests.RequestException as e:
             print(f"Error querying Ollama: {e}")
-            return "Error querying Ollama"
+            return OLLAMA_ERROR_RESPONSE
 
-    def stream_generate(self, prompt: str, callback) -> str:
+    def generate(
+        self,
+        prompt: str,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
+        # Streamed, even though nothing is shown until the answer is complete,
+        # so Ctrl+C can stop it between chunks
+        data = self._chat_data(
+            prompt,
+            system,
+            history,
+            self._token_options(max_tokens),
+            generation_method,
+        )
+        return self._stream_chat(data)
+
+    def stream_generate(
+        self,
+        prompt: str,
+        callback,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
+        data = self._chat_data(
+            prompt,
+            system,
+            history,
+            self._token_options(max_tokens),
+            generation_method,
+        )
+        return self._stream_chat(data, callback)
+
+    def _stream_chat(self, data: dict, callback=None) -> str:
+        """Send a streaming chat request, passing each chunk to the callback
+
+        Unlike _chat, the request can be cancelled between chunks.
+        """
+        self._check_cancelled()
+        with self._generating():
+            try:
+                with self.session.post(
+                    f"{self.base_url}/chat",
+                    json=data,
+                    stream=True,
+                    timeout=OLLAMA_TIMEOUT,
+                ) as response:
+                    response.raise_for_status()
+                    parts = []
+                    for line in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                        # Leaving the with block closes the connection, which
+                        # stops Ollama generating
+                        self._check_cancelled()
+                        if line:
+                            json_response = json_loads(line)
+                            if "message" in json_response:
+                                chunk = json_response["message"]["content"]
+                                parts.append(chunk)
+                                if callback:
+                                    callback(chunk)
+                    return "".join(parts)
+            except requests.RequestException as e:
+                print(f"Error querying Ollama: {e}")
+                return OLLAMA_ERROR_RESPONSE
+
+    def generate_json(
+        self,
+        prompt: str,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        schema: Optional[dict] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        # A batch answers every field of a form, so it gets a budget sized to
+        # the form rather than to a single answer. It's streamed, even though
+        # nothing is shown until it's complete, so Ctrl+C can stop it midway.
+        data = self._chat_data(
+            prompt,
+            system,
+            history,
+            options={"num_predict": max_tokens or MAX_JSON_ANSWER_TOKENS},
+            format=schema or "json",
+        )
+        return self._stream_chat(data)
+
+    def embed(self, text: str) -> Optional[List[float]]:
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        if not self.embedding_model_name or not texts:
+            return [None] * len(texts)
+
+        # /embed takes a list of inputs, so all texts share one request
+        url = f"{self.base_url}/embed"
+        data = {
+            "model": self.embedding_model_name,
+            "input": texts,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+        }
+
+        try:
+            response = self.session.post(url, json=data, timeout=OLLAMA_TIMEOUT)
+            response.raise_for_status()
+            embeddings = response.json().get("embeddings") or []
+        except requests.RequestException as e:
+            # Don't retry (and re-report) on every field for this session
+            print(f"Error embedding with Ollama, disabling semantic cache: {e}")
+            self.embedding_model_name = None
+            return [None] * len(texts)
+        if len(embeddings) != len(texts):
+            return [None] * len(texts)
+        return embeddings
+
+    def _set_keep_alive(self, model_name: str, keep_alive, **kwargs):
+        # A generate request without a prompt only loads or unloads the model
         url = f"{self.base_url}/generate"
-        data = {"model": self.model_name, "prompt": prompt}
+        data = {"model": model_name, "keep_alive": keep_alive, **kwargs}
+        self.session.post(url, json=data, timeout=OLLAMA_TIMEOUT).raise_for_status()
 
+    def warm_up(self, system: Optional[str] = None):
+        if system:
+            # Generating a single token loads the model and leaves the system
+            # message's KV cache ready for the first field
+            data = self._chat_data("", system, None, options={"num_predict": 1})
+            self._chat({**data, "stream": False})
+            return
         try:
-            with requests.post(url, json=data, stream=True) as response:
-                response.raise_for_status()
-                full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        json_response = json.loads(line)
-                        if "response" in json_response:
-                            chunk = json_response["response"]
-                            full_response += chunk
-                            callback(chunk)
-                return full_response
+            # Load with the same options the answers use so it isn't reloaded
+            self._set_keep_alive(
+                self.model_name, OLLAMA_KEEP_ALIVE, options=OLLAMA_OPTIONS
+            )
         except requests.RequestException as e:
-            print(f"Error querying Ollama: {e}")
-            return "Error querying Ollama"
+            print(f"Error loading Ollama model: {e}")
+
+    def close(self):
+        # The models are otherwise kept loaded indefinitely, so unload them
+        for model_name in (self.model_name, self.embedding_model_name):
+            if not model_name:
+                continue
+            try:
+                self._set_keep_alive(model_name, 0)
+            except requests.RequestException:
+                pass
+        self.session.close()
+
+
+class PrefixKVStore:
+    """KV caches of prompt prefixes, persisted to disk between sessions"""
+
+    def __init__(
+        self, directory: str = PREFIX_KV_DIR, max_files: int = MAX_PREFIX_KV_FILES
+    ):
+        self.directory = directory
+        self.max_files = max_files
+
+    @staticmethod
+    def fingerprint(*parts: str) -> str:
+        """Hash everything that determines a prefix's KV cache into a file name"""
+        return hashlib.sha256("||".join(parts).encode()).hexdigest()
+
+    def _path(self, fingerprint: str) -> str:
+        return os.path.join(self.directory, f"{fingerprint}.pt")
+
+    def get(self, fingerprint: str, device: str) -> Optional[tuple]:
+        """Return the stored per-layer (key, value) tensors, or None"""
+        import torch
+
+        try:
+            return torch.load(
+                self._path(fingerprint), map_location=device, weights_only=True
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, RuntimeError, EOFError) as e:
+            print(f"Error loading cached prompt prefix: {e}")
+            return None
+
+    def put(self, fingerprint: str, layers: tuple):
+        import torch
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(fingerprint)
+        try:
+            torch.save(layers, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            # The stored cache only saves time, so failing to write it is fine
+            print(f"Error saving cached prompt prefix: {e}")
+            return
+        finally:
+            # Only left behind when the save failed before the rename
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + ".tmp")
+
+        # Only keep the most recently written prefixes
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".pt")
+        ]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for old_path in paths[self.max_files :]:
+            os.remove(old_path)
 
 
 class HuggingFaceInterface(ModelInterface):
     def __init__(self, model_path: str):
+        super().__init__()
         self.model_path = model_path
         # Import here to avoid loading dependencies unless HF interface is used
-        from transformers import AutoModelForCausalLM, AutoTokenizer
+        from transformers import (
+            AutoModelForCausalLM,
+            AutoTokenizer,
+            StoppingCriteria,
+            StoppingCriteriaList,
+        )
         import torch
 
         print(f"Loading model from {model_path}...")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.device == "cpu":
+            dtype = torch.float32
+        elif torch.cuda.is_bf16_supported():
+            # Same memory bandwidth as fp16, without fp16's overflow risk
+            dtype = torch.bfloat16
+        else:
+            dtype = torch.float16
+        self.dtype = dtype
+        if self.device == "cuda" and importlib.util.find_spec("flash_attn"):
+            # Tiled attention that never materializes the full score matrix
+            attention = "flash_attention_2"
+        else:
+            # PyTorch's fused scaled_dot_product_attention kernels
+            attention = "sdpa"
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        # Batched prompts are padded on the left, so every row's answer starts
+        # right after its prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model = AutoModelForCausalLM.from_pretrained(
             model_path,
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            torch_dtype=dtype,
             device_map="auto",
+            attn_implementation=attention,
+        )
+        # Token ids and KV cache of the last system message, which is shared
+        # by every prompt
+        self._prefix_text = None
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self._prefix_lock = threading.Lock()
+        self.kv_store = PrefixKVStore()
+
+        cancel_event = self.cancel_event
+
+        class Cancelled(StoppingCriteria):
+            """Stops every row of a generation once cancel_event is set"""
+
+            def __call__(self, input_ids, scores, **kwargs):
+                return torch.full(
+                    (input_ids.shape[0],),
+                    cancel_event.is_set(),
+                    dtype=torch.bool,
+                    device=input_ids.device,
+                )
+
+        self._stopping_criteria = StoppingCriteriaList([Cancelled()])
+        # The history grows by one answer per field and is sent with every
+        # prompt, so each part of a prompt is only tokenized the first time
+        self._segment_ids = functools.lru_cache(maxsize=1024)(self._tokenize_segment)
+
+    @staticmethod
+    def _format_prompt(
+        prompt: str,
+        system: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+    ) -> str:
+        lines = [system] if system else []
+        for message in history or []:
+            lines.append(f"{message['role'].capitalize()}: {message['content']}")
+        lines.append(prompt)
+        return PROMPT_SEPARATOR.join(lines)
+
+    def _tokenize_segment(self, text: str) -> tuple:
+        """Token ids of text as tokenized right after PROMPT_SEPARATOR
+
+        Tokenized on its own, text could start differently, e.g. with the "▁"
+        SentencePiece adds at the start of a string. So it's tokenized after
+        the separator, whose own ids are then dropped.
+        """
+        separator_ids = self.tokenizer(PROMPT_SEPARATOR, add_special_tokens=False)[
+            "input_ids"
+        ]
+        ids = self.tokenizer(PROMPT_SEPARATOR + text, add_special_tokens=False)[
+            "input_ids"
+        ]
+        return tuple(ids[len(separator_ids) :])
+
+    def _suffix_ids(
+        self, prompt: str, history: Optional[List[Dict[str, str]]]
+    ) -> List[int]:
+        """Token ids of the history and prompt that follow the system message"""
+        ids = []
+        for message in history or []:
+            ids.extend(
+                self._segment_ids(
+                    f"{message['role'].capitalize()}: {message['content']}"
+                    + PROMPT_SEPARATOR
+                )
+            )
+        ids.extend(self._segment_ids(prompt))
+        return ids
+
+    def _prime_prefix(self, system: str):
+        """Tokenize the system message and run it through the model once
+
+        The resulting KV cache is also stored on disk, so later sessions with
+        the same model and context skip the forward pass. Must be called with
+        _prefix_lock held.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        prefix_ids = self.tokenizer(system + PROMPT_SEPARATOR, return_tensors="pt")[
+            "input_ids"
+        ].to(self.device)
+        fingerprint = self.kv_store.fingerprint(
+            self.model_path, str(self.dtype), system
         )
+        layers = self.kv_store.get(fingerprint, self.device)
+        if layers is not None:
+            cache = DynamicCache.from_legacy_cache(layers)
+        else:
+            with torch.inference_mode():
+                outputs = self.model(
+                    input_ids=prefix_ids,
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                )
+            cache = outputs.past_key_values
+            self.kv_store.put(fingerprint, cache.to_legacy_cache())
+        self._prefix_ids = prefix_ids
+        self._prefix_cache = cache
+        self._prefix_text = system
+
+    def _prefix(self, system: str, rows: int) -> tuple:
+        """Return the system message's token ids and its KV cache for rows rows
+
+        generate() extends the cache in place, so each call gets its own copy.
+        generate() also repeats its inputs for each beam but not a cache passed
+        in, so rows must count every beam of every prompt.
+        """
+        with self._prefix_lock:
+            if system != self._prefix_text:
+                self._prime_prefix(system)
+            prefix_ids = self._prefix_ids
+            cache = copy.deepcopy(self._prefix_cache)
+        if rows > 1:
+            cache.batch_repeat_interleave(rows)
+        return prefix_ids, cache
+
+    def _tokenize(
+        self,
+        prompt: str,
+        system: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        num_beams: int = 1,
+    ) -> dict:
+        """Tokenize a prompt, reusing the work done on an unchanged system message
 
-    def generate(self, prompt: str) -> str:
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        print("Now starting generation...")
-        outputs = self.model.generate(
+        The returned inputs carry a KV cache of the system message, so
+        generation only has to process the rest of the prompt.
+        """
+        import torch
+
+        if not system:
+            text = self._format_prompt(prompt, None, history)
+            return self.tokenizer(text, return_tensors="pt").to(self.device)
+
+        prefix_ids, cache = self._prefix(system, num_beams)
+        suffix_ids = torch.tensor(
+            [self._suffix_ids(prompt, history)], device=self.device
+        )
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=-1)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "past_key_values": cache,
+        }
+
+    def _generate(self, **kwargs):
+        """Run model.generate without any autograd bookkeeping"""
+        import torch
+
+        # generate() itself only disables gradients. Inference mode also skips
+        # version counting, and every cached tensor is created under it.
+        with torch.inference_mode(), self._generating():
+            return self.model.generate(
+                **kwargs, stopping_criteria=self._stopping_criteria
+            )
+
+    def warm_up(self, system: Optional[str] = None):
+        if not system:
+            return
+        with self._prefix_lock:
+            if system != self._prefix_text:
+                self._prime_prefix(system)
+
+    def generate(
+        self,
+        prompt: str,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
+        self._check_cancelled()
+        generation_kwargs = GENERATION_METHODS[
+            generation_method or self.generation_method
+        ]
+        inputs = self._tokenize(
+            prompt, system, history, generation_kwargs.get("num_beams", 1)
+        )
+        outputs = self._generate(
             **inputs,
-            max_new_tokens=32,
+            max_new_tokens=max_tokens or MAX_ANSWER_TOKENS,
             num_return_sequences=1,
-            temperature=0.7,
-            do_sample=True,
             pad_token_id=self.tokenizer.eos_token_id,
+            **generation_kwargs,
         )
-        print("Finished generation")
-        return self.tokenizer.decode(outputs[0], skip_special_tokens=True)[
-            len(prompt) :
+        # A cancelled generation stops early, so its partial answer is dropped
+        self._check_cancelled()
+        # Only decode the answer, not the prompt it continues
+        prompt_length = inputs["input_ids"].shape[-1]
+        return self.tokenizer.decode(
+            outputs[0, prompt_length:], skip_special_tokens=True
+        )
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        token_limits: Optional[List[Optional[int]]] = None,
+    ) -> List[str]:
+        token_limits = [
+            max_tokens or MAX_ANSWER_TOKENS
+            for max_tokens in token_limits or [None] * len(prompts)
         ]
+        num_beams = GENERATION_METHODS[self.generation_method].get("num_beams", 1)
+        batch_size = max(1, MAX_BATCH_ROWS // num_beams)
+        responses = []
+        for start in range(0, len(prompts), batch_size):
+            responses.extend(
+                self._generate_chunk(
+                    prompts[start : start + batch_size],
+                    system,
+                    history,
+                    token_limits[start : start + batch_size],
+                )
+            )
+        return responses
+
+    def _generate_chunk(
+        self,
+        prompts: List[str],
+        system: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        token_limits: List[int],
+    ) -> List[str]:
+        """Answer at most MAX_BATCH_ROWS rows' worth of prompts in one batch"""
+        import torch
 
-    def stream_generate(self, prompt: str, callback) -> str:
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        full_response = ""
+        self._check_cancelled()
+        generation_kwargs = GENERATION_METHODS[self.generation_method]
+        if system:
+            # Every row starts with the same system message, so its cache is
+            # repeated for each row and the padding goes between the system
+            # message and the prompt
+            prefix_ids, cache = self._prefix(
+                system, len(prompts) * generation_kwargs.get("num_beams", 1)
+            )
+            suffixes = self.tokenizer.pad(
+                {
+                    "input_ids": [
+                        self._suffix_ids(prompt, history) for prompt in prompts
+                    ]
+                },
+                return_tensors="pt",
+            ).to(self.device)
+            prefix_ids = prefix_ids.expand(len(prompts), -1)
+            inputs = {
+                "input_ids": torch.cat([prefix_ids, suffixes["input_ids"]], dim=-1),
+                "attention_mask": torch.cat(
+                    [torch.ones_like(prefix_ids), suffixes["attention_mask"]], dim=-1
+                ),
+                "past_key_values": cache,
+            }
+        else:
+            texts = [self._format_prompt(prompt, None, history) for prompt in prompts]
+            inputs = dict(
+                self.tokenizer(texts, padding=True, return_tensors="pt").to(self.device)
+            )
 
-        print("Now starting generation...")
-        for outputs in self.model.generate(
+        outputs = self._generate(
             **inputs,
-            max_new_tokens=32,
-            num_return_sequences=1,
-            temperature=0.7,
-            do_sample=True,
-            pad_token_id=self.tokenizer.eos_token_id,
-            streaming=True,
-        ):
-            print("Doing another token")
-            token = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            full_response += token
-            callback(token)
-        print("Finished generation")
+            max_new_tokens=max(token_limits),
+            pad_token_id=self.tokenizer.pad_token_id,
+            **generation_kwargs,
+        )
+        self._check_cancelled()
+        # The rows share one length limit, so cut each back to its own
+        new_tokens = outputs[:, inputs["input_ids"].shape[-1] :]
+        return [
+            self.tokenizer.decode(tokens[:max_tokens], skip_special_tokens=True)
+            for tokens, max_tokens in zip(new_tokens, token_limits)
+        ]
 
-        return full_response[len(prompt) :]
+    def stream_generate(
+        self,
+        prompt: str,
+        callback,
+        system: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        max_tokens: Optional[int] = None,
+        generation_method: Optional[str] = None,
+    ) -> str:
+        from transformers import TextIteratorStreamer
+
+        inputs = self._tokenize(prompt, system, history)
+        # generate() only returns once it is done, so run it in the background
+        # and read the decoded text from the streamer as each token is produced
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=STREAM_POLL_INTERVAL,
+        )
+        method = generation_method or self.generation_method
+        if GENERATION_METHODS[method].get("num_beams", 1) > 1:
+            # Beam search can't stream, since the best beam is only known
+            # at the end
+            method = "greedy"
+        errors = []
+
+        def run():
+            try:
+                self._generate(
+                    **inputs,
+                    max_new_tokens=max_tokens or MAX_ANSWER_TOKENS,
+                    num_return_sequences=1,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    streamer=streamer,
+                    **GENERATION_METHODS[method],
+                )
+            except Exception as e:
+                # Raised again in the caller, once the stream is ended here
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        parts = []
+        thread.start()
+        while True:
+            try:
+                token = next(streamer)
+            except StopIteration:
+                break
+            except queue.Empty:
+                if self.cancel_event.is_set():
+                    # Let the stopping criteria end the generation before
+                    # cancel_event is cleared
+                    thread.join()
+                    self._check_cancelled()
+                continue
+            # The stopping criteria end a cancelled generation at its next
+            # token, and whatever is still queued is discarded
+            self._check_cancelled()
+            parts.append(token)
+            callback(token)
+        thread.join()
+        if errors:
+            raise errors[0]
+        # The streamer also ends early when the generation was cancelled
+        self._check_cancelled()
+        return "".join(parts)
 
 
 def get_model_interface(model_type: str, model_name: str) -> Optional[ModelInterface]:
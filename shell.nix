@@ -15,6 +15,9 @@ pkgs.mkShell {
     pythonPackages.virtualenv
   ];
 
+  # Let `ollama serve` answer several form fields concurrently
+  OLLAMA_NUM_PARALLEL = "4";
+
   shellHook = ''
     rm -rf venv/
     python3 -m venv venv
@@ -0,0 +1,79 @@
+import pytest
+
+pytest.importorskip("transformers")
+from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+from tokenizers.processors import TemplateProcessing
+from tokenizers.trainers import BpeTrainer
+from transformers import PreTrainedTokenizerFast
+
+from model_interface import PROMPT_SEPARATOR, HuggingFaceInterface
+
+SYSTEM = "Job applicant information:\nAda Lovelace, ada@example.com\n\nYou are an assistant to the job applicant."
+HISTORY = [
+    {"role": "user", "content": "Field 'First name'"},
+    {"role": "assistant", "content": "Ada"},
+    {"role": "user", "content": "Field 'Why do you want to work here?'"},
+    {"role": "assistant", "content": "  I enjoy building engines.\n"},
+]
+PROMPT = "Fill in the form field described below.\n\nField: input id=email label=Email\nAnswer:"
+
+# Pre-tokenization regex of Llama 3's byte-level BPE tokenizer
+LLAMA3_PATTERN = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}"
+    r"| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+
+
+def byte_level_pre_tokenizer():
+    """Splits like Llama 3 and GPT-style tokenizers"""
+    return pre_tokenizers.Sequence(
+        [
+            pre_tokenizers.Split(Regex(LLAMA3_PATTERN), behavior="isolated"),
+            pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+        ]
+    )
+
+
+def sentencepiece_pre_tokenizer():
+    """Splits like Llama 2's SentencePiece tokenizer, with "▁" before the text"""
+    return pre_tokenizers.Sequence(
+        [
+            pre_tokenizers.Split("\n", behavior="isolated"),
+            pre_tokenizers.Metaspace(prepend_scheme="first"),
+        ]
+    )
+
+
+@pytest.fixture(params=[byte_level_pre_tokenizer, sentencepiece_pre_tokenizer])
+def interface(request):
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = request.param()
+    tokenizer.decoder = decoders.ByteLevel()
+    corpus = [HuggingFaceInterface._format_prompt(PROMPT, SYSTEM, HISTORY)] * 10
+    tokenizer.train_from_iterator(
+        corpus,
+        BpeTrainer(
+            vocab_size=300,
+            special_tokens=["<s>", "</s>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    tokenizer.post_processor = TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", tokenizer.token_to_id("<s>"))]
+    )
+
+    interface = HuggingFaceInterface.__new__(HuggingFaceInterface)
+    interface.tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>"
+    )
+    interface._segment_ids = interface._tokenize_segment
+    return interface
+
+
+def test_suffix_ids_match_single_pass_tokenization(interface):
+    text = interface._format_prompt(PROMPT, SYSTEM, HISTORY)
+    prefix_ids = interface.tokenizer(SYSTEM + PROMPT_SEPARATOR)["input_ids"]
+
+    ids = prefix_ids + interface._suffix_ids(PROMPT, HISTORY)
+
+    assert ids == interface.tokenizer(text)["input_ids"]